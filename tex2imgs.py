@@ -1,42 +1,111 @@
 import os
+import hashlib
+import itertools
+import json
+import mmap
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 import re
-from typing import List
+from typing import Iterator, List, Tuple, Union
 import jinja2
 
-def extract_preamble(latex_string: str) -> List[str]:
+# Patterns are compiled once at import time; the extraction helpers below run
+# once per file and once per equation, so compiling them on each call adds up.
+# The document patterns are bytes patterns so they can scan memory-mapped files directly.
+
+# A LaTeX document as text, raw bytes, or a memory-mapped file
+LatexSource = Union[str, bytes, mmap.mmap]
+
+# Combined pattern to find all three preamble command types:
+# 1. \usepackage: Handles optional arguments [...]
+# 2. \renewcommand: Handles required arguments {...}{...}
+# 3. \newcommand: Handles optional arguments [...] and required arguments {...}{...}
+# The leading backslash is shared, so positions without one are rejected before
+# any alternative is tried.
+_PREAMBLE_RE = re.compile(
+    rb'\\(?:'
+    rb'usepackage(?:\[.*?\])?\{.*?\}'          # \usepackage[options]{package}
+    rb'|'
+    rb'renewcommand\{.*?\}\{.*?\}'             # \renewcommand{cmd}{def}
+    rb'|'
+    rb'newcommand(?:\[.*?\])?\{.*?\}\{.*?\}'   # \newcommand[args]{cmd}{def}
+    rb')',
+    re.DOTALL
+)
+
+# Each equation kind is scanned independently, so e.g. inline math inside an environment
+# is extracted too, and an unbalanced $ can't hide a later environment.
+# Group body: inner_content
+# 1. LaTeX Environments (\begin{align*}...\end{align*})
+_ENV_RE = re.compile(
+    rb'\\begin\{(?P<env_name>equation|align|gather|multline|flalign|alignat|split|cases)\*?\}(?P<body>.*?)\\end\{(?P=env_name)\*?\}',
+    re.DOTALL
+)
+# 2. Double Dollar Signs ($$ Display Math $$)
+_DD_RE = re.compile(rb'\$\$(?P<body>[\s\S]*?)\$\$', re.DOTALL)
+# 3. Inline Dollar Signs ($ Inline Math $) have no pattern: they're found by _iter_inline_equations,
+#    a plain scan that avoids the backtracking of a lazy body with lookarounds.
+
+# Structural noise removed before the numeric check (whitespace, alignment markers, line breaks)
+_STRIP_TABLE = str.maketrans('', '', ' \t\n\r\f\v&]')
+_NUMERIC_SET = frozenset('0123456789.')
+
+_POSTPROC_BEGIN_RE = re.compile(r'\\begin\{(equation|align|gather|multline|flalign|alignat)\}')
+_POSTPROC_END_RE = re.compile(r'\\end\{(equation|align|gather|multline|flalign|alignat)\}')
+
+# The template is looked up next to this script so that importing the module doesn't
+# depend on the working directory. It only substitutes the preamble and the equation, so it's
+# rendered once with placeholders and split around them; writing each equation's .tex file
+# is then a plain bytes join. Splitting with a capturing group keeps the placeholder names
+# (at the odd indices), so the template may use them in any order and any number of times.
+_JINJA_ENV = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(os.path.dirname(os.path.abspath(__file__))),
+    autoescape=jinja2.select_autoescape()
+)
+_TEMPLATE = _JINJA_ENV.get_template("template.tex")
+_TEMPLATE_PARTS = [
+    part if i % 2 else part.encode()
+    for i, part in enumerate(re.split('\0(preamble|equation)\0', _TEMPLATE.render(preamble='\0preamble\0', equation='\0equation\0')))
+]
+
+# An image is up to date when the hash stored next to it matches the hash of everything it was
+# rendered from: the template's own text, the preamble, the equation, and the render settings.
+# Bump _RENDER_VERSION whenever the latex/dvipng command lines change.
+_TEMPLATE_TEXT = b''.join(part for i, part in enumerate(_TEMPLATE_PARTS) if i % 2 == 0)
+_RENDER_VERSION = 1
+
+# Extraction results are cached here, keyed by a hash of the file contents.
+_CACHE_DIR = './tmp/cache'
+# Part of the cache key; bump it whenever a change to the extraction code changes its results,
+# so entries written by older code are not reused.
+_EXTRACTION_VERSION = 3
+
+# Building the preamble format costs about as much as one latex run, so it only pays off
+# when at least this many equations are rendered with it.
+_MIN_JOBS_FOR_FORMAT = 3
+
+def _as_bytes(latex_string: LatexSource) -> Union[bytes, mmap.mmap]:
+    """
+    Encodes text so it can be scanned with the bytes patterns; bytes and mmaps are returned as is.
+    """
+    return latex_string.encode() if isinstance(latex_string, str) else latex_string
+
+def extract_preamble(latex_string: LatexSource) -> List[str]:
     """
     Extracts LaTeX preamble-related statements: usepackage, renewcommand, and newcommand.
 
     Args:
-        latex_string: A string containing the LaTeX document content.
+        latex_string: The LaTeX document content (text, bytes or a memory-mapped file).
 
     Returns:
-        A list of strings, where each string is a stripped command statement.
+        A list of strings, where each string is a stripped command statement, in document order.
     """
-    # Combined pattern to find all three command types:
-    # 1. \usepackage: Handles optional arguments [...]
-    # 2. \renewcommand: Handles required arguments {...}{...}
-    # 3. \newcommand: Handles optional arguments [...] and required arguments {...}{...}
-    preamble_pattern = re.compile(
-        r'('
-        r'\\usepackage(\[.*?\])?\{.*?\}'          # \usepackage[options]{package}
-        r'|'
-        r'\\renewcommand\{.*?\}\{.*?\}'           # \renewcommand{cmd}{def}
-        r'|'
-        r'\\newcommand(\[.*?\])?\{.*?\}\{.*?\}'   # \newcommand[args]{cmd}{def}
-        r')',
-        re.DOTALL
-    )
-
-    # findall returns a list of tuples since there are multiple capturing groups in the pattern.
-    # The first element of each tuple (index 0) is the entire match (Group 1).
-    matches = preamble_pattern.findall(latex_string)
-
-    # Extract the full match from each tuple
-    preamble_statements = [match[0].strip() for match in matches]
-
-    return list(set(preamble_statements))
+    # The pattern has no capturing groups; each statement is the entire match, deduplicated as we go.
+    # dict.fromkeys keeps document order, so the preamble (and the image hashes built from it)
+    # doesn't change between runs.
+    return list(dict.fromkeys(match.group().decode().strip() for match in _PREAMBLE_RE.finditer(_as_bytes(latex_string))))
 
 def _is_purely_numeric_content(content: str) -> bool:
     """
@@ -52,24 +121,19 @@ def _is_purely_numeric_content(content: str) -> bool:
     """
     # 1. Clean the content by removing common LaTeX structural noise (whitespace, alignment markers, line breaks)
     # This helps focus only on the actual mathematical symbols.
-    cleaned_content = re.sub(r'[\s&\]]', '', content)
-    
+    cleaned_content = content.translate(_STRIP_TABLE)
+
+    # 2. A bold number (\mathbf{12}) is still just a number, so look inside it.
+    if cleaned_content.startswith('\\mathbf{') and cleaned_content.endswith('}'):
+        cleaned_content = cleaned_content[len('\\mathbf{'):-1]
+
     if not cleaned_content:
         # If the content is empty (e.g., $ $), it is not "purely numeric," so we keep it.
         return False
-    
-    # 2. Look for any character that signifies a *non-numeric* equation.
-    # This includes letters (variables), math operators (+, -, =, etc.), or LaTeX command start (\).
-    if re.search(r'[a-zA-Z+\-*/=<>\\]', cleaned_content):
-        # If these exist, it's a real equation, not just a number.
-        return False 
 
-    # 3. If we reach here, the content only contains digits and dots (after removing operators/variables).
-    # We use re.fullmatch to ensure the entire cleaned string is composed ONLY of digits and dots.
-    if re.fullmatch(r'[\d.]+', cleaned_content) or re.fullmatch(r'\\mathbf\{[\d.]+\}', cleaned_content):
-        return True # It is purely numeric (e.g., "123", "4.5", "12.34").
-        
-    return False
+    # 3. Any character other than digits and dots (variables, operators, LaTeX commands)
+    # means it's a real equation. At least one digit is required, so a lone "." is kept.
+    return all(c in _NUMERIC_SET for c in cleaned_content) and any(c.isdigit() for c in cleaned_content)
 
 
 def _is_commented_out(content: str) -> bool:
@@ -82,10 +146,12 @@ def _is_commented_out(content: str) -> bool:
     Returns:
         True if all non-whitespace content is commented out, False otherwise.
     """
-    lines = content.split('\n')
-    
+    if '%' not in content:
+        # Without any comment marker, only blank content counts as commented out.
+        return not content.strip()
+
     # We look for any line that contains non-whitespace content AND doesn't start with a comment marker.
-    for line in lines:
+    for line in content.splitlines():
         stripped_line = line.strip()
         # If the line has content and does NOT start with a comment marker, it's not commented out.
         if stripped_line and not stripped_line.startswith('%'):
@@ -96,7 +162,71 @@ def _is_commented_out(content: str) -> bool:
     return True
 
 
-def extract_latex_equations(latex_string: str) -> List[str]:
+def _is_escaped(latex_string: Union[bytes, mmap.mmap], index: int) -> bool:
+    """
+    Checks if the character at index is escaped, i.e. preceded by an odd number of backslashes
+    (\\$ is a literal dollar sign, while \\\\$ is a line break followed by math).
+    """
+    backslashes = 0
+    while index - backslashes > 0 and latex_string[index - backslashes - 1] == ord('\\'):
+        backslashes += 1
+    return backslashes % 2 == 1
+
+def _find_inline_end(latex_string: Union[bytes, mmap.mmap], start: int) -> int:
+    """
+    Finds the unescaped $ closing an inline equation whose content starts at start.
+
+    Returns:
+        The index of the closing $, or -1 if the inline equation is never closed.
+    """
+    end = latex_string.find(b'$', start)
+    while end != -1 and _is_escaped(latex_string, end):
+        end = latex_string.find(b'$', end + 1)
+    return end
+
+def _iter_pattern_matches(latex_string: Union[bytes, mmap.mmap], anchor: bytes, pattern: re.Pattern) -> Iterator[Tuple[bytes, bytes]]:
+    """
+    Yields the non-overlapping matches of an equation pattern whose matches all start with anchor.
+
+    The anchor is located with find and the pattern is only tried there, instead of having
+    the regex engine attempt a match at every position of the prose.
+
+    Returns:
+        An iterator of (full_match, inner_content) pairs.
+    """
+    position = 0
+    while (start := latex_string.find(anchor, position)) != -1:
+        match = pattern.match(latex_string, start)
+        if match is None or _is_escaped(latex_string, start):
+            # Not an equation: e.g. \begin{figure}, or \\begin, which is a line break followed by text
+            position = start + 1
+            continue
+        yield match.group(), match.group('body')
+        position = match.end()
+
+def _iter_inline_equations(latex_string: Union[bytes, mmap.mmap]) -> Iterator[Tuple[bytes, bytes]]:
+    """
+    Yields the non-overlapping inline equations ($...$), skipping $$ and literal dollar signs (\\$).
+
+    Returns:
+        An iterator of (full_match, inner_content) pairs.
+    """
+    position = 0
+    while (start := latex_string.find(b'$', position)) != -1:
+        position = start + 1
+        if _is_escaped(latex_string, start) or (start > 0 and latex_string[start - 1] == ord('$')):
+            continue
+        end = _find_inline_end(latex_string, start + 1)
+        if end == -1:
+            # No unescaped $ left, so no more inline equations either
+            return
+        if end == start + 1 or latex_string[end + 1:end + 2] == b'$':
+            # Empty, or running into a $$: this $ doesn't open an inline equation
+            continue
+        yield latex_string[start:end + 1], latex_string[start + 1:end]
+        position = end + 1
+
+def extract_latex_equations(latex_string: LatexSource) -> List[str]:
     """
     Extracts all LaTeX equations from a given string, including their surrounding delimiters
     or environment markers (e.g., \begin{align*}...\end{align*}, $$, or $).
@@ -104,44 +234,75 @@ def extract_latex_equations(latex_string: str) -> List[str]:
     Equations that contain only numbers or are fully commented out are filtered out.
 
     Args:
-        latex_string: A string containing the LaTeX document content.
+        latex_string: The LaTeX document content (text, bytes or a memory-mapped file).
 
     Returns:
         A list of unique equation strings, including their original delimiters.
     """
-    equations = []
+    equations = set()
 
-    # --- 1. Match LaTeX Environments ---
-    # Group 1: full_match, Group 2: env_name, Group 3: inner_content
-    env_pattern = re.compile(
-        r'(\\begin\{(equation|align|gather|multline|flalign|alignat|split|cases)\*?\}(.*?)\\end\{\2\*?\})',
-        re.DOTALL
+    latex_string = _as_bytes(latex_string)
+    matches = itertools.chain(
+        _iter_pattern_matches(latex_string, b'\\begin{', _ENV_RE),
+        _iter_pattern_matches(latex_string, b'$$', _DD_RE),
+        _iter_inline_equations(latex_string),
     )
-
-    env_matches = env_pattern.findall(latex_string)
-    for full_match, _, inner_content in env_matches:
+    for full_match, inner_content in matches:
+        # Only the matched slices are decoded
+        inner_content = inner_content.decode()
         if not _is_purely_numeric_content(inner_content) and not _is_commented_out(inner_content):
-            equations.append(full_match.strip())
+            equations.add(full_match.decode().strip())
 
-    # --- 2. Match Double Dollar Signs ($$ Display Math $$) ---
-    # Group 1: full_match, Group 2: inner_content
-    dd_pattern = re.compile(r'(\$\$([\s\S]*?)\$\$)', re.DOTALL)
-    dd_matches = dd_pattern.findall(latex_string)
-    for full_match, inner_content in dd_matches:
-        if not _is_purely_numeric_content(inner_content) and not _is_commented_out(inner_content):
-            equations.append(full_match.strip())
-
-    # --- 3. Match Inline Dollar Signs ($ Inline Math $) ---
-    # Group 1: full_match, Group 2: inner_content
-    # The inner content matching group is necessary for filtering
-    id_pattern = re.compile(r'((?<!\$)\$([^\$]+?)\$(?!\$))', re.DOTALL)
-    id_matches = id_pattern.findall(latex_string)
-    for full_match, inner_content in id_matches:
-        if not _is_purely_numeric_content(inner_content) and not _is_commented_out(inner_content):
-            equations.append(full_match.strip())
+    return list(equations)
 
-    return list(set(equations))
 
+def extract_cached(latex_document: LatexSource) -> Tuple[List[str], List[str]]:
+    """
+    Extracts equations and preamble statements from a LaTeX document, reusing the results
+    of a previous run when the document's contents haven't changed.
+
+    Args:
+        latex_document: The LaTeX document content (text, bytes or a memory-mapped file).
+    Returns:
+        A tuple with the extracted equations and the preamble statements.
+    """
+    latex_document = _as_bytes(latex_document)
+    digest = hashlib.blake2b(latex_document, digest_size=16).hexdigest()
+    cache_path = os.path.join(_CACHE_DIR, f'{digest}-v{_EXTRACTION_VERSION}.json')
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        return cached['equations'], cached['preamble']
+
+    equations = extract_latex_equations(latex_document)
+    preamble_statements = extract_preamble(latex_document)
+
+    # Write to a private file first so concurrent workers never see a partial cache entry
+    os.makedirs(_CACHE_DIR, exist_ok=True)
+    tmp_path = f'{cache_path}.{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        json.dump({'equations': equations, 'preamble': preamble_statements}, f)
+    os.replace(tmp_path, cache_path)
+    return equations, preamble_statements
+
+def extract_from_file(path: str) -> Tuple[List[str], List[str]]:
+    """
+    Extracts equations and preamble statements from a LaTeX file (see extract_cached).
+
+    The file is memory-mapped rather than read, so large documents are paged in by the OS
+    as the patterns scan them instead of being copied into memory.
+
+    Args:
+        path: The path to the LaTeX file.
+    Returns:
+        A tuple with the extracted equations and the preamble statements.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files can't be memory-mapped
+            return extract_cached(b'')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as latex_document:
+            return extract_cached(latex_document)
 
 def make_tex_file(equation: str, preamble: str, filename: str) -> None:
     """
@@ -149,15 +310,12 @@ def make_tex_file(equation: str, preamble: str, filename: str) -> None:
 
     Args:
         equation: The LaTeX equation string to write.
+        preamble: The preamble statements to include.
         filename: The output .tex filename.
     """
-    env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader("."),
-        autoescape=jinja2.select_autoescape()
-    )
-    template = env.get_template("template.tex")
-    rendered_tex = template.render(preamble=preamble, equation=equation)
-    with open(filename, 'w') as f:
+    values = {'preamble': preamble.encode(), 'equation': equation.encode()}
+    rendered_tex = b''.join(values[part] if i % 2 else part for i, part in enumerate(_TEMPLATE_PARTS))
+    with open(filename, 'wb') as f:
         f.write(rendered_tex)
 
 def post_process_equation(equation: str) -> str:
@@ -170,8 +328,8 @@ def post_process_equation(equation: str) -> str:
         The processed LaTeX equation string.
     """
     # make numbered equations unnumbered
-    equation = re.sub(r'\\begin\{(equation|align|gather|multline|flalign|alignat)\}', r'\\begin{\1*}', equation)
-    equation = re.sub(r'\\end\{(equation|align|gather|multline|flalign|alignat)\}', r'\\end{\1*}', equation)
+    equation = _POSTPROC_BEGIN_RE.sub(r'\\begin{\1*}', equation)
+    equation = _POSTPROC_END_RE.sub(r'\\end{\1*}', equation)
     return equation
 
 def get_equation_label(equation: str) -> str | None:
@@ -183,40 +341,201 @@ def get_equation_label(equation: str) -> str | None:
     Returns:
         The label string if found, otherwise an empty string.
     """
-    label_pattern = re.compile(r'\\label\{(.*?)\}')
-    match = label_pattern.search(equation)
-    if match:
-        return match.group(1).replace(":", "_")
-    return None
+    # Most equations have no label, so a plain substring search settles them without a regex
+    start = equation.find('\\label{')
+    if start == -1:
+        return None
+    start += len('\\label{')
+    end = equation.find('}', start)
+    if end == -1:
+        return None
+    return equation[start:end].replace(":", "_")
+
+def _unique_path(path: str, used_paths: set) -> str:
+    """
+    Makes an image path unique among the ones already used, and marks it as used.
 
-def process_tex_file(path: str, output_dir: str, preamble: str) -> str:
+    Two equations can resolve to the same image (a repeated \\label, or a label such as 1 that
+    equals another equation's number). Rendered concurrently, they would overwrite each other,
+    so the later ones get a numbered suffix (equation_1_2.png, ...).
+
+    Args:
+        path: The image path the equation would normally be written to.
+        used_paths: The image paths already taken; updated in place.
+    Returns:
+        The path to write the image to.
     """
-    Processes a LaTeX file to extract equations and convert them to images.
+    unique_path, suffix = path, 2
+    while unique_path in used_paths:
+        unique_path = f'{path[:-len(".png")]}_{suffix}.png'
+        suffix += 1
+    used_paths.add(unique_path)
+    return unique_path
+
+def _render_hash(preamble: str, equation: str) -> str:
+    """
+    Hashes everything an equation's image is rendered from (see _RENDER_VERSION).
 
     Args:
-        path: The path to the LaTeX file.
+        preamble: The preamble the equation is rendered with.
+        equation: The post-processed LaTeX equation string.
+    Returns:
+        The hex digest stored next to the image.
     """
-    with open(path, 'r') as f:
-        latex_document = f.read()
+    rendered_from = b'\0'.join((str(_RENDER_VERSION).encode(), _TEMPLATE_TEXT, preamble.encode(), equation.encode()))
+    return hashlib.blake2b(rendered_from, digest_size=8).hexdigest()
 
-    extracted_equations = extract_latex_equations(latex_document)
-    preamble_statements = extract_preamble(latex_document)
-    preamble = '\n'.join(preamble_statements)
+def _run(args: List[str]) -> int:
+    """
+    Runs an external command directly (no shell), discarding its output.
 
-    os.makedirs('./tmp/texs', exist_ok=True)
-    os.makedirs('./tmp/pdfs', exist_ok=True)
-    os.makedirs('./tmp/crops', exist_ok=True)
+    Args:
+        args: The command and its arguments.
+    Returns:
+        The command's exit code.
+    """
+    return subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False).returncode
+
+def build_preamble_format(tex_path: str, output_directory: str) -> str | None:
+    """
+    Dumps everything before \\begin{document} in a .tex file into a latex format file,
+    so documents sharing that preamble don't have to reload its packages on every run.
+
+    Args:
+        tex_path: A .tex file whose preamble should be precompiled.
+        output_directory: The directory where the format file is written.
+    Returns:
+        The format path to pass to latex's -fmt option, or None if it couldn't be built.
+    """
+    fmt_path = os.path.join(output_directory, 'precompiled.fmt')
+    if os.path.exists(fmt_path):
+        os.remove(fmt_path)
+    _run(['latex', '-ini', '-interaction=nonstopmode', f'-output-directory={output_directory}',
+          '-jobname=precompiled', '&latex', 'mylatexformat.ltx', tex_path])
+    return fmt_path[:-len('.fmt')] if os.path.exists(fmt_path) else None
+
+def _prepare_jobs(path: str, output_dir: str, preamble_statements: List[str], tex_dir: str,
+                  used_paths: set) -> Tuple[str, List[Tuple[str, str, str]]]:
+    """
+    Writes a .tex file for each equation of a LaTeX file whose image is out of date.
 
-    for i, eq in enumerate(extracted_equations):
+    Args:
+        path: The path to the LaTeX file.
+        output_dir: The directory to save the output images.
+        preamble_statements: Preamble statements shared with other files; the file's own
+            statements are added to them.
+        tex_dir: The scratch directory for the equations' .tex files.
+        used_paths: The image paths already taken (see _unique_path); updated in place.
+    Returns:
+        The preamble used for the file's equations, and a (tex_path, output_path, eq_hash)
+        render job for each equation that needs rendering.
+    """
+    extracted_equations, file_statements = extract_from_file(path)
+    # Add this file's own statements to the ones passed in, skipping those already there
+    known_statements = set(preamble_statements)
+    new_statements = [statement for statement in file_statements if statement not in known_statements]
+    preamble = '\n'.join([*preamble_statements, *new_statements])
+
+    os.makedirs(tex_dir, exist_ok=True)
+
+    # Sorted so that unlabeled equations keep the same number between runs
+    jobs = []
+    for i, eq in enumerate(sorted(extracted_equations)):
         eq = post_process_equation(eq)
         label = get_equation_label(eq)
         output_path = f'{output_dir}/equation_{label}.png' if label else f'{output_dir}/equation_{i+1}.png'
+        output_path = _unique_path(output_path, used_paths)
+
+        # Skip equations whose image was already rendered from the same template, preamble,
+        # equation and settings. The hash of what was rendered is stored next to the image.
+        eq_hash = _render_hash(preamble, eq)
+        if os.path.exists(output_path) and os.path.exists(f'{output_path}.hash'):
+            with open(f'{output_path}.hash', 'r') as f:
+                if f.read() == eq_hash:
+                    continue
+
+        tex_path = f'{tex_dir}/equation_{i+1}.tex'
+        make_tex_file(eq, preamble, tex_path)
+        jobs.append((tex_path, output_path, eq_hash))
+    return preamble, jobs
+
+def _build_jobs_format(jobs: List[Tuple[str, str, str]], tmp_dir: str) -> str | None:
+    """
+    Builds the preamble format shared by a list of render jobs, unless there are too few
+    of them for it to pay off.
+
+    Args:
+        jobs: (tex_path, output_path, eq_hash) render jobs, as returned by _prepare_jobs.
+        tmp_dir: A scratch directory for the format file.
+    Returns:
+        The format path for _render_jobs, or None to render with plain latex.
+    """
+    # Every equation shares the same preamble, so load its packages once into a format file.
+    # If that fails (e.g. mylatexformat is not installed) fall back to plain latex.
+    if len(jobs) < _MIN_JOBS_FOR_FORMAT:
+        return None
+    return build_preamble_format(jobs[0][0], tmp_dir)
+
+def _render_jobs(jobs: List[Tuple[str, str, str]], fmt: str | None = None, max_workers: int | None = None) -> None:
+    """
+    Renders equation .tex files to images. All jobs must share the same preamble.
 
-        make_tex_file(eq, preamble, f'./tmp/texs/equation_{i+1}.tex')
-        os.system(f'pdflatex -interaction=nonstopmode -output-directory ./tmp/pdfs ./tmp/texs/equation_{i+1}.tex > /dev/null 2>&1')
-        os.system(f"pdfcrop -margins 3 ./tmp/pdfs/equation_{i+1}.pdf ./tmp/crops/equation_{i+1}-crop.pdf")
-        os.system(f"magick -density 300 ./tmp/crops/equation_{i+1}-crop.pdf -quality 90 {output_path}")
-        os.system(f'rm ./tmp/pdfs/equation_{i+1}.log ./tmp/pdfs/equation_{i+1}.aux')
+    Args:
+        jobs: (tex_path, output_path, eq_hash) render jobs, as returned by _prepare_jobs.
+        fmt: A preamble format built by _build_jobs_format, or None to render with plain latex.
+        max_workers: How many equations to render at once. Defaults to the number of CPUs.
+    """
+    fmt_args = [f'-fmt={fmt}'] if fmt else []
+
+    def _render_one(tex_path: str, output_path: str, eq_hash: str) -> None:
+        # The DVI and its log/aux files are written next to the .tex file
+        tex_dir = os.path.dirname(tex_path)
+        name = os.path.basename(tex_path)[:-len('.tex')]
+        dvi_path = f'{tex_dir}/{name}.dvi'
+
+        # In nonstopmode latex still writes a DVI after errors, so its exit code decides whether
+        # the result is usable; a failed equation gets no hash and is retried on the next run.
+        # dvipng crops to the tight bounding box and writes the PNG itself,
+        # so neither pdfcrop nor ImageMagick are needed
+        latex_args = ['-interaction=nonstopmode', '-output-directory', tex_dir, tex_path]
+        latex_ok = _run(['latex', *fmt_args, *latex_args]) == 0
+        # A format can build and still fail to load (e.g. a package that mylatexformat can't dump),
+        # so give the equation one more try without it before treating it as broken.
+        if not latex_ok and fmt_args:
+            latex_ok = _run(['latex', *latex_args]) == 0
+        if latex_ok and _run(['dvipng', '-T', 'tight', '-D', '300', '-bg', 'Transparent', '-o', output_path, dvi_path]) == 0:
+            with open(f'{output_path}.hash', 'w') as f:
+                f.write(eq_hash)
+        for aux_path in (dvi_path, f'{tex_dir}/{name}.log', f'{tex_dir}/{name}.aux'):
+            if os.path.exists(aux_path):
+                os.remove(aux_path)
+
+    # Equations are independent and the work is spent in subprocesses, so threads suffice.
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        futures = [executor.submit(_render_one, *job) for job in jobs]
+        for future in futures:
+            future.result()
+
+def process_tex_file(path: str, output_dir: str, preamble_statements: List[str], max_workers: int | None = None) -> str:
+    """
+    Processes a LaTeX file to extract equations and convert them to images.
+
+    Args:
+        path: The path to the LaTeX file.
+        output_dir: The directory to save the output images.
+        preamble_statements: Preamble statements shared with other files; the file's own
+            statements are added to them.
+        max_workers: How many equations to render at once. Defaults to the number of CPUs.
+    Returns:
+        The preamble used to render the file's equations.
+    """
+    # The scratch directory is private to this process and removed when done, even if rendering fails.
+    tmp_dir = f'./tmp/{os.getpid()}'
+    try:
+        preamble, jobs = _prepare_jobs(path, output_dir, preamble_statements, f'{tmp_dir}/texs', set())
+        _render_jobs(jobs, _build_jobs_format(jobs, tmp_dir), max_workers)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
     return preamble
 
 
@@ -227,17 +546,40 @@ def process_directory(input_dir: str) -> None:
 
     Args:
         input_dir: The directory containing LaTeX files.
-        output_dir: The directory to save the output images.
     """
     os.makedirs('images', exist_ok=True)
-    agg_preamble = ''
-    for dirpath, _, filenames in os.walk(input_dir):
-        for filename in filenames:
+    tex_files = []
+    # Walked in sorted order so the aggregated preamble is the same on every run
+    for dirpath, dirnames, filenames in os.walk(input_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
             if filename.endswith('.tex'):
                 output_dir = os.path.join("images/", dirpath.lstrip('./'), filename[:-4])
                 os.makedirs(output_dir, exist_ok=True)
-                preamble = process_tex_file(os.path.join(dirpath, filename), output_dir, agg_preamble)
-                agg_preamble += '\n' + preamble
+                tex_files.append((os.path.join(dirpath, filename), output_dir))
+
+    # The preamble is aggregated across all files, so collect it serially first;
+    # it's only a regex scan and the expensive rendering happens afterwards.
+    preamble_parts = []
+    for path, _ in tex_files:
+        _, preamble_statements = extract_from_file(path)
+        preamble_parts.extend(preamble_statements)
+    # Files usually share packages and commands; redefining a \newcommand is an error, so drop repeats
+    agg_preamble = list(dict.fromkeys(preamble_parts))
+
+    # The equations of all files go through one shared pool, so a large file keeps every CPU
+    # busy after the small ones are done, without running more latex processes than CPUs.
+    tmp_dir = f'./tmp/{os.getpid()}'
+    try:
+        jobs = []
+        used_paths = set()
+        for n, (path, output_dir) in enumerate(tex_files):
+            _, file_jobs = _prepare_jobs(path, output_dir, agg_preamble, f'{tmp_dir}/texs/{n}', used_paths)
+            jobs.extend(file_jobs)
+        # Every file is rendered with the aggregated preamble, so a single format serves them all
+        _render_jobs(jobs, _build_jobs_format(jobs, tmp_dir))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
 if __name__ == '__main__':